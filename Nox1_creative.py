@@ -15,12 +15,20 @@
 # %%
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import numpy as np
 import joblib
+from numba import njit
 import matplotlib.pyplot as plt
 from PIL import Image
 import time
 import requests
 from io import BytesIO
+import hashlib
+import os
+import tempfile
+import warnings
 import plotly.express as px
 
 # --- Page Config ---
@@ -79,11 +87,16 @@ Ce projet a pour objectif de **modéliser et surveiller les émissions de NOx**
 """)
 
 # --- Satellite Image ---
+@st.cache_data(ttl=86400, show_spinner=False)
+def fetch_image(url: str) -> Image.Image:
+    r = requests.get(url, timeout=10)
+    r.raise_for_status()
+    return Image.open(BytesIO(r.content)).copy()
+
 st.markdown("## 🌍 Données Satellites")
 try:
     url = "https://eoimages.gsfc.nasa.gov/images/imagerecords/144000/144348/pollution_nox_omi_2021_lrg.jpg"
-    response = requests.get(url)
-    img = Image.open(BytesIO(response.content))
+    img = fetch_image(url)
     st.image(img, caption="Pollution mondiale au NOx (NASA, 2021)", use_column_width=True)
 except:
     st.warning("Impossible de charger l'image.")
@@ -96,34 +109,123 @@ if not uploaded_file:
     st.stop()
 
 # --- Load and Preprocess Data ---
-df = pd.read_csv(uploaded_file, na_values=["null", "NA"])
-df['date'] = pd.to_datetime(df['date'], format="%d.%m.%Y %H:%M")
-X = df.drop(columns=['date', 'Nox_baf', 'Nox opsis'], errors='ignore')
-X = X.apply(pd.to_numeric, errors='coerce').fillna(X.mean())
+# Parsed uploads are kept as Parquet in a private per-app directory, keyed on the file
+# content. Bump CACHE_VERSION whenever the parsing in load_data changes.
+CACHE_VERSION = 2
+CACHE_KEEP = 8
+CACHE_DIR = os.path.join(tempfile.gettempdir(), f"nox_cache_{os.path.splitext(os.path.basename(__file__))[0]}")
+
+def prune_cache():
+    # Keep the CACHE_KEEP newest files of this CACHE_VERSION; drop other versions and
+    # temp files left for over an hour by writers that died
+    now = time.time()
+    current = []
+    for e in os.scandir(CACHE_DIR):
+        try:
+            mtime = e.stat().st_mtime
+            if e.name.startswith(f"v{CACHE_VERSION}_") and e.name.endswith(".parquet"):
+                current.append((mtime, e.path))
+            elif not e.name.endswith(".tmp") or now - mtime > 3600:
+                os.remove(e.path)
+        except OSError:
+            pass  # removed concurrently by another session
+    for _, p in sorted(current, reverse=True)[CACHE_KEEP:]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_data(file_bytes: bytes) -> pd.DataFrame:
+    path = os.path.join(CACHE_DIR, f"v{CACHE_VERSION}_{hashlib.md5(file_bytes).hexdigest()}.parquet")
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        pass  # absent, truncated or unreadable: parse the CSV again
+    # Arrow's default null_values already include "null" and "NA"
+    try:
+        df = pacsv.read_csv(BytesIO(file_bytes),
+                            convert_options=pacsv.ConvertOptions(strings_can_be_null=True)).to_pandas()
+    except pa.ArrowInvalid:
+        # Arrow rejects ragged rows that pandas fills with NaN
+        df = pd.read_csv(BytesIO(file_bytes), na_values=["null", "NA"])
+    df['date'] = pd.to_datetime(df['date'], format="%d.%m.%Y %H:%M")
+    # Best effort: write to a unique temp file (owner-only, from mkstemp), then rename atomically
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                df.to_parquet(fh, compression="snappy", index=False)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        prune_cache()
+    except Exception:
+        pass
+    return df
 
 # --- Load Models ---
-model_baf = joblib.load("Nox1_modèle.pkl")
-model_opsis = joblib.load("Nox_opsis_linearregression.pkl")
+@st.cache_resource
+def get_models():
+    return joblib.load("Nox1_modèle.pkl"), joblib.load("Nox_opsis_linearregression.pkl")
 
-# --- Predictions ---
-df['Nox_baf_pred'] = model_baf.predict(X)
-df['Nox_opsis_pred'] = model_opsis.predict(X)
+# The OPSIS model is linear: keep its weights in float32 so predicting is one SGEMV on Xv
+@st.cache_resource
+def get_opsis_weights():
+    _, model_opsis = get_models()
+    return model_opsis.coef_.astype(np.float32), np.float32(model_opsis.intercept_)
 
 # --- Alert Levels ---
-def get_alert(value, att, dang):
-    if value >= dang: return "DANGER"
-    elif value >= att: return "ATTENTION"
-    return "OK"
+ALERT_LEVELS = ["OK", "ATTENTION", "DANGER"]
+
+@njit(cache=True)
+def _alert_codes(v, att, dang, out):
+    for i in range(v.size):
+        x = v[i]
+        out[i] = 2 if x >= dang else (1 if x >= att else 0)
 
-df['Alerte_baf'] = df['Nox_baf_pred'].apply(get_alert, args=(400, 500))
-df['Alerte_opsis'] = df['Nox_opsis_pred'].apply(get_alert, args=(350, 450))
+def get_alert(values, att, dang):
+    out = np.empty(values.size, np.int8)
+    _alert_codes(values.to_numpy(dtype=np.float32), att, dang, out)
+    return pd.Categorical.from_codes(out, categories=ALERT_LEVELS, ordered=True)
+
+# --- Predictions ---
+@st.cache_data(show_spinner=False, max_entries=4)
+def compute_predictions(file_bytes: bytes) -> pd.DataFrame:
+    df = load_data(file_bytes)
+    df.sort_values('date', inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    model_baf, _ = get_models()
+    w_opsis, b_opsis = get_opsis_weights()
+
+    # Training columns, in training order; one C-contiguous float32 buffer for both models
+    Xn = df[model_baf.feature_names_in_].apply(pd.to_numeric, errors='coerce')
+    means = Xn.mean()
+    Xn.fillna(means, inplace=True)
+    Xv = np.ascontiguousarray(Xn.to_numpy(), dtype=np.float32)
+    # Xv is already in feature_names_in_ order, so sklearn's missing-feature-names warning is noise
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names", category=UserWarning)
+        df['Nox_baf_pred'] = model_baf.predict(Xv).astype(np.float32)
+    df['Nox_opsis_pred'] = Xv @ w_opsis + b_opsis
+
+    df['Alerte_baf'] = get_alert(df['Nox_baf_pred'], 400, 500)
+    df['Alerte_opsis'] = get_alert(df['Nox_opsis_pred'], 350, 450)
+    return df
+
+df = compute_predictions(uploaded_file.getvalue())
 
 # --- Graphs ---
 st.markdown("## 📊 Visualisation des Prédictions")
 target = st.selectbox("Choisir le capteur", ["BAF", "OPSIS"])
 date_range = st.date_input("Plage de dates", [df.date.min().date(), df.date.max().date()])
 start, end = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
-df_filtered = df[(df['date'] >= start) & (df['date'] <= end)]
+dates = df['date'].to_numpy()
+i0 = dates.searchsorted(np.datetime64(start), side='left')
+i1 = dates.searchsorted(np.datetime64(end), side='right')
+df_filtered = df.iloc[i0:i1]
 
 pred_col = 'Nox_baf_pred' if target == "BAF" else 'Nox_opsis_pred'
 alert_col = 'Alerte_baf' if target == "BAF" else 'Alerte_opsis'
@@ -134,10 +236,19 @@ fig = px.scatter(df_filtered, x="date", y=pred_col, color=alert_col,
 st.plotly_chart(fig, use_container_width=True)
 
 # --- Final Table ---
+TABLE_ROWS = 1000
 st.markdown("## 🧾 Récapitulatif des Données")
-st.dataframe(df[['date', 'Nox opsis', 'Nox_opsis_pred', 'Alerte_opsis', 'Nox_baf', 'Nox_baf_pred', 'Alerte_baf']])
+st.dataframe(df[['date', 'Nox opsis', 'Nox_opsis_pred', 'Alerte_opsis', 'Nox_baf', 'Nox_baf_pred', 'Alerte_baf']].head(TABLE_ROWS),
+             use_container_width=True)
+if len(df) > TABLE_ROWS:
+    st.caption(f"Affichage des {TABLE_ROWS} premières lignes sur {len(df)}. Utilisez le bouton de téléchargement pour tout obtenir.")
 
 # --- Download Button ---
+@st.cache_data(show_spinner=False, max_entries=4)
+def to_csv_bytes(file_bytes: bytes) -> bytes:
+    # Keyed on the upload: Streamlit only samples large DataFrames when hashing them
+    return compute_predictions(file_bytes).to_csv(index=False).encode("utf-8")
+
 st.markdown("## 💾 Téléchargement")
-st.download_button("Télécharger les résultats", df.to_csv(index=False).encode("utf-8"), "nox_resultats.csv", "text/csv")
+st.download_button("Télécharger les résultats", to_csv_bytes(uploaded_file.getvalue()), "nox_resultats.csv", "text/csv")
 
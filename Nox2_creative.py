@@ -15,12 +15,20 @@
 # %%
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import numpy as np
 import joblib
-import matplotlib.pyplot as plt
+from numba import njit
 from PIL import Image
 import time
 import requests
 from io import BytesIO
+import hashlib
+import os
+import tempfile
+import warnings
+import plotly.express as px
 
 # Configuration générale
 st.set_page_config(page_title="NOx Monitor | Cimenterie", layout="wide")
@@ -52,11 +60,16 @@ Ce projet vise à **modéliser les émissions de NOx** (oxydes d'azote) dans une
 """)
 
 # --- 🛰️ Image météo/satellite ---
+@st.cache_data(ttl=86400, show_spinner=False)
+def fetch_image(url: str) -> Image.Image:
+    r = requests.get(url, timeout=10)
+    r.raise_for_status()
+    return Image.open(BytesIO(r.content)).copy()
+
 st.markdown("### 🌍 Images météo et satellite")
 try:
     url = "https://eoimages.gsfc.nasa.gov/images/imagerecords/144000/144348/pollution_nox_omi_2021_lrg.jpg"
-    image_response = requests.get(url)
-    img = Image.open(BytesIO(image_response.content))
+    img = fetch_image(url)
     st.image(img, caption="Carte mondiale de la pollution au NOx (NASA, 2021)", use_column_width=True)
 except:
     st.warning("Impossible de charger l'image satellite.")
@@ -69,36 +82,128 @@ if not uploaded_file:
     st.sidebar.warning("Merci de charger un fichier CSV pour commencer.")
     st.stop()
 
-df = pd.read_csv(uploaded_file, na_values=["null", "NA"])
-df['date'] = pd.to_datetime(df['date'], format="%d.%m.%Y %H:%M")
-
-# --- 🧪 Préparation des données ---
-X = df.drop(columns=['date', 'Nox_baf', 'Nox opsis'])
-X = X.apply(pd.to_numeric, errors='coerce').fillna(X.mean())
+# Les fichiers déjà analysés sont gardés en Parquet dans un dossier privé propre à l'app,
+# indexés par le hash du contenu. Incrémenter CACHE_VERSION si l'analyse de load_data change.
+CACHE_VERSION = 2
+CACHE_KEEP = 8
+CACHE_DIR = os.path.join(tempfile.gettempdir(), f"nox_cache_{os.path.splitext(os.path.basename(__file__))[0]}")
+
+def prune_cache():
+    # Garde les CACHE_KEEP fichiers les plus récents de cette CACHE_VERSION ; supprime les
+    # autres versions et les fichiers temporaires abandonnés depuis plus d'une heure
+    now = time.time()
+    current = []
+    for e in os.scandir(CACHE_DIR):
+        try:
+            mtime = e.stat().st_mtime
+            if e.name.startswith(f"v{CACHE_VERSION}_") and e.name.endswith(".parquet"):
+                current.append((mtime, e.path))
+            elif not e.name.endswith(".tmp") or now - mtime > 3600:
+                os.remove(e.path)
+        except OSError:
+            pass  # déjà supprimé par une autre session
+    for _, p in sorted(current, reverse=True)[CACHE_KEEP:]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_data(file_bytes: bytes) -> pd.DataFrame:
+    path = os.path.join(CACHE_DIR, f"v{CACHE_VERSION}_{hashlib.md5(file_bytes).hexdigest()}.parquet")
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        pass  # absent, tronqué ou illisible : on relit le CSV
+    # Les null_values par défaut d'Arrow couvrent déjà "null" et "NA"
+    try:
+        df = pacsv.read_csv(BytesIO(file_bytes),
+                            convert_options=pacsv.ConvertOptions(strings_can_be_null=True)).to_pandas()
+    except pa.ArrowInvalid:
+        # Arrow refuse les lignes incomplètes que pandas complète avec NaN
+        df = pd.read_csv(BytesIO(file_bytes), na_values=["null", "NA"])
+    df['date'] = pd.to_datetime(df['date'], format="%d.%m.%Y %H:%M")
+    # Au mieux : fichier temporaire unique (droits propriétaire, via mkstemp) puis renommage atomique
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                df.to_parquet(fh, compression="snappy", index=False)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        prune_cache()
+    except Exception:
+        pass
+    return df
 
 # --- 🤖 Chargement des modèles ---
-model_baf = joblib.load("Nox1_modèle.pkl")
-model_opsis = joblib.load("Nox_opsis_linearregression.pkl")
+@st.cache_resource
+def get_models():
+    return joblib.load("Nox1_modèle.pkl"), joblib.load("Nox_opsis_linearregression.pkl")
 
-# --- 🔮 Prédictions ---
-df['Nox_baf_pred'] = model_baf.predict(X)
-df['Nox_opsis_pred'] = model_opsis.predict(X)
+# Le modèle OPSIS est linéaire : poids en float32, la prédiction devient un seul produit sur Xv
+@st.cache_resource
+def get_opsis_weights():
+    _, model_opsis = get_models()
+    return model_opsis.coef_.astype(np.float32), np.float32(model_opsis.intercept_)
 
 # --- 🚨 Alertes ---
-def alerte(val, seuil_att, seuil_dang):
-    if val >= seuil_dang: return "DANGER"
-    elif val >= seuil_att: return "ATTENTION"
-    return "OK"
+NIVEAUX_ALERTE = ["OK", "ATTENTION", "DANGER"]
+
+@njit(cache=True)
+def _codes_alerte(v, seuil_att, seuil_dang, out):
+    for i in range(v.size):
+        x = v[i]
+        out[i] = 2 if x >= seuil_dang else (1 if x >= seuil_att else 0)
 
-df['Alerte_baf'] = df['Nox_baf_pred'].apply(alerte, args=(400, 500))
-df['Alerte_opsis'] = df['Nox_opsis_pred'].apply(alerte, args=(350, 450))
+def alerte(valeurs, seuil_att, seuil_dang):
+    out = np.empty(valeurs.size, np.int8)
+    _codes_alerte(valeurs.to_numpy(dtype=np.float32), seuil_att, seuil_dang, out)
+    return pd.Categorical.from_codes(out, categories=NIVEAUX_ALERTE, ordered=True)
+
+def ajouter_alerte_globale(df):
+    # Niveau le plus sévère des deux capteurs, calculé sur les codes des catégories ordonnées
+    if 'Alerte' not in df.columns:
+        codes = np.maximum(df['Alerte_baf'].cat.codes.to_numpy(), df['Alerte_opsis'].cat.codes.to_numpy())
+        df['Alerte'] = pd.Categorical.from_codes(codes, categories=NIVEAUX_ALERTE, ordered=True)
+
+# --- 🔮 Prédictions ---
+@st.cache_data(show_spinner=False, max_entries=4)
+def compute_predictions(file_bytes: bytes) -> pd.DataFrame:
+    df = load_data(file_bytes)
+    df.sort_values('date', inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    model_baf, _ = get_models()
+    w_opsis, b_opsis = get_opsis_weights()
+
+    # Préparation des données : colonnes d'entraînement, dans l'ordre, en un seul tableau float32 contigu
+    Xn = df[model_baf.feature_names_in_].apply(pd.to_numeric, errors='coerce')
+    means = Xn.mean()
+    Xn.fillna(means, inplace=True)
+    Xv = np.ascontiguousarray(Xn.to_numpy(), dtype=np.float32)
+    # Xv suit déjà l'ordre de feature_names_in_ : l'avertissement de sklearn sur les noms de colonnes est inutile
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names", category=UserWarning)
+        df['Nox_baf_pred'] = model_baf.predict(Xv).astype(np.float32)
+    df['Nox_opsis_pred'] = Xv @ w_opsis + b_opsis
+
+    df['Alerte_baf'] = alerte(df['Nox_baf_pred'], 400, 500)
+    df['Alerte_opsis'] = alerte(df['Nox_opsis_pred'], 350, 450)
+    return df
+
+df = compute_predictions(uploaded_file.getvalue())
 
 # --- 📊 Distribution des alertes ---
 st.markdown("### 📊 Distribution des alertes NOx")
-fig, axes = plt.subplots(1, 2, figsize=(12, 4))
-df['Alerte_baf'].value_counts().plot.bar(ax=axes[0], color="lightblue", title="BAF")
-df['Alerte_opsis'].value_counts().plot.bar(ax=axes[1], color="salmon", title="OPSIS")
-st.pyplot(fig)
+c1, c2 = st.columns(2)
+c1.markdown("**BAF**")
+c1.bar_chart(df['Alerte_baf'].value_counts(), color="#add8e6")
+c2.markdown("**OPSIS**")
+c2.bar_chart(df['Alerte_opsis'].value_counts(), color="#fa8072")
 
 # --- 📅 Visualisation temporelle ---
 st.markdown("### 🕒 Visualisation temporelle interactive")
@@ -107,33 +212,41 @@ date_range = st.date_input("Plage de dates", [df.date.min().date(), df.date.max(
 start = pd.to_datetime(date_range[0])
 end = pd.to_datetime(date_range[1])
 
-df_f = df[(df['date'] >= start) & (df['date'] <= end)]
+dates = df['date'].to_numpy()
+i0 = dates.searchsorted(np.datetime64(start), side='left')
+i1 = dates.searchsorted(np.datetime64(end), side='right')
+df_f = df.iloc[i0:i1]
 col_pred = 'Nox_baf_pred' if target == "BAF" else 'Nox_opsis_pred'
 col_alert = 'Alerte_baf' if target == "BAF" else 'Alerte_opsis'
 seuils = (400, 500) if target == "BAF" else (350, 450)
 
-fig, ax = plt.subplots(figsize=(12, 5))
-colors = {"OK": "green", "ATTENTION": "orange", "DANGER": "red"}
-for lvl, c in colors.items():
-    sub = df_f[df_f[col_alert] == lvl]
-    ax.scatter(sub.date, sub[col_pred], label=lvl, c=c, s=10)
+fig = px.scatter(df_f, x="date", y=col_pred, color=col_alert,
+                 color_discrete_map={"OK": "green", "ATTENTION": "orange", "DANGER": "red"},
+                 title=f"{target} prédits dans le temps")
 for s in seuils:
-    ax.axhline(s, linestyle="--", color="gray")
-ax.set_title(f"{target} prédits dans le temps")
-ax.legend()
-st.pyplot(fig)
+    fig.add_hline(y=s, line_dash="dash", line_color="gray")
+st.plotly_chart(fig, use_container_width=True)
 
 # --- 📋 Résumé final ---
 st.markdown("### 🧾 Tableau récapitulatif")
-if 'Alerte' not in df.columns:
-    df['Alerte'] = df[['Alerte_opsis', 'Alerte_baf']].max(axis=1)
+ajouter_alerte_globale(df)
 
+LIGNES_AFFICHEES = 1000
 colonnes = ['date', 'Nox opsis', 'Nox_opsis_pred', 'Alerte_opsis',
             'Nox_baf', 'Nox_baf_pred', 'Alerte_baf', 'Alerte']
-st.dataframe(df[colonnes])
+st.dataframe(df[colonnes].head(LIGNES_AFFICHEES), use_container_width=True)
+if len(df) > LIGNES_AFFICHEES:
+    st.caption(f"Affichage des {LIGNES_AFFICHEES} premières lignes sur {len(df)}. Utilisez le bouton de téléchargement pour tout obtenir.")
 
 # --- ⬇️ Téléchargement ---
+@st.cache_data(show_spinner=False, max_entries=4)
+def to_csv_bytes(file_bytes: bytes) -> bytes:
+    # Clé = le fichier importé : Streamlit n'échantillonne que les grands DataFrames pour le hash
+    df = compute_predictions(file_bytes)
+    ajouter_alerte_globale(df)
+    return df.to_csv(index=False).encode('utf-8')
+
 st.markdown("### 💾 Télécharger les résultats")
-csv = df.to_csv(index=False).encode('utf-8')
+csv = to_csv_bytes(uploaded_file.getvalue())
 st.download_button("📥 Télécharger les résultats CSV", csv, "resultats_nox.csv", "text/csv")
 
@@ -1,7 +1,17 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import numpy as np
 import joblib
-import matplotlib.pyplot as plt
+from numba import njit
+from io import BytesIO
+import hashlib
+import os
+import tempfile
+import time
+import warnings
+import plotly.express as px
 
 st.set_page_config(page_title="NOx Prediction", layout="wide")
 st.title("Prédiction de la pollution NOx")
@@ -15,58 +25,148 @@ if not uploaded_file:
     st.stop()
 
 # 2. Chargement et parsing
-df = pd.read_csv(uploaded_file, na_values=["null","NA"])
-df['date'] = pd.to_datetime(df['date'], format="%d.%m.%Y %H:%M")
+# Les fichiers déjà analysés sont gardés en Parquet dans un dossier privé propre à l'app,
+# indexés par le hash du contenu. Incrémenter CACHE_VERSION si l'analyse de load_data change.
+CACHE_VERSION = 2
+CACHE_KEEP = 8
+CACHE_DIR = os.path.join(tempfile.gettempdir(), f"nox_cache_{os.path.splitext(os.path.basename(__file__))[0]}")
 
-# 3. Préparation des features
-X = df.drop(columns=['date','Nox_baf','Nox opsis'])
-X = X.apply(pd.to_numeric, errors='coerce').fillna(X.mean())
+def prune_cache():
+    # Garde les CACHE_KEEP fichiers les plus récents de cette CACHE_VERSION ; supprime les
+    # autres versions et les fichiers temporaires abandonnés depuis plus d'une heure
+    now = time.time()
+    current = []
+    for e in os.scandir(CACHE_DIR):
+        try:
+            mtime = e.stat().st_mtime
+            if e.name.startswith(f"v{CACHE_VERSION}_") and e.name.endswith(".parquet"):
+                current.append((mtime, e.path))
+            elif not e.name.endswith(".tmp") or now - mtime > 3600:
+                os.remove(e.path)
+        except OSError:
+            pass  # déjà supprimé par une autre session
+    for _, p in sorted(current, reverse=True)[CACHE_KEEP:]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
 
-# 4. Chargement des modèles
-model_baf = joblib.load("Nox1_modèle.pkl")
-model_opsis = joblib.load("Nox_opsis_linearregression.pkl")
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_data(file_bytes: bytes) -> pd.DataFrame:
+    path = os.path.join(CACHE_DIR, f"v{CACHE_VERSION}_{hashlib.md5(file_bytes).hexdigest()}.parquet")
+    try:
+        return pd.read_parquet(path)
+    except Exception:
+        pass  # absent, tronqué ou illisible : on relit le CSV
+    # Les null_values par défaut d'Arrow couvrent déjà "null" et "NA"
+    try:
+        df = pacsv.read_csv(BytesIO(file_bytes),
+                            convert_options=pacsv.ConvertOptions(strings_can_be_null=True)).to_pandas()
+    except pa.ArrowInvalid:
+        # Arrow refuse les lignes incomplètes que pandas complète avec NaN
+        df = pd.read_csv(BytesIO(file_bytes), na_values=["null","NA"])
+    df['date'] = pd.to_datetime(df['date'], format="%d.%m.%Y %H:%M")
+    # Au mieux : fichier temporaire unique (droits propriétaire, via mkstemp) puis renommage atomique
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                df.to_parquet(fh, compression="snappy", index=False)
+            os.replace(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        prune_cache()
+    except Exception:
+        pass
+    return df
 
-# 5. Prédiction
-df['Nox_baf_pred']   = model_baf.predict(X)
-df['Nox_opsis_pred'] = model_opsis.predict(X)
+# 3. Chargement des modèles
+@st.cache_resource
+def get_models():
+    return joblib.load("Nox1_modèle.pkl"), joblib.load("Nox_opsis_linearregression.pkl")
 
-# 6. Alertes
-def alerte(val, seuil_att, seuil_dang):
-    if val >= seuil_dang: return "DANGER"
-    if val >= seuil_att: return "ATTENTION"
-    return "OK"
+# Le modèle OPSIS est linéaire : poids en float32, la prédiction devient un seul produit sur Xv
+@st.cache_resource
+def get_opsis_weights():
+    _, model_opsis = get_models()
+    return model_opsis.coef_.astype(np.float32), np.float32(model_opsis.intercept_)
 
-df['Alerte_baf']   = df['Nox_baf_pred'].apply(alerte, args=(400,500))
-df['Alerte_opsis'] = df['Nox_opsis_pred'].apply(alerte, args=(350,450))
+# 4. Alertes
+NIVEAUX_ALERTE = ["OK","ATTENTION","DANGER"]
 
-# 7. Distribution des alertes
+@njit(cache=True)
+def _codes_alerte(v, seuil_att, seuil_dang, out):
+    for i in range(v.size):
+        x = v[i]
+        out[i] = 2 if x>=seuil_dang else (1 if x>=seuil_att else 0)
+
+def alerte(valeurs, seuil_att, seuil_dang):
+    out = np.empty(valeurs.size, np.int8)
+    _codes_alerte(valeurs.to_numpy(dtype=np.float32), seuil_att, seuil_dang, out)
+    return pd.Categorical.from_codes(out, categories=NIVEAUX_ALERTE, ordered=True)
+
+# 5. Préparation des features, prédiction et alertes (une fois par fichier)
+@st.cache_data(show_spinner=False, max_entries=4)
+def compute_predictions(file_bytes: bytes) -> pd.DataFrame:
+    df = load_data(file_bytes)
+    df.sort_values('date', inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    model_baf, _ = get_models()
+    w_opsis, b_opsis = get_opsis_weights()
+
+    # Colonnes d'entraînement, dans l'ordre ; un seul tableau float32 contigu pour les deux modèles
+    Xn = df[model_baf.feature_names_in_].apply(pd.to_numeric, errors='coerce')
+    means = Xn.mean()
+    Xn.fillna(means, inplace=True)
+    Xv = np.ascontiguousarray(Xn.to_numpy(), dtype=np.float32)
+    # Xv suit déjà l'ordre de feature_names_in_ : l'avertissement de sklearn sur les noms de colonnes est inutile
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="X does not have valid feature names", category=UserWarning)
+        df['Nox_baf_pred']   = model_baf.predict(Xv).astype(np.float32)
+    df['Nox_opsis_pred'] = Xv @ w_opsis + b_opsis
+
+    df['Alerte_baf']   = alerte(df['Nox_baf_pred'], 400, 500)
+    df['Alerte_opsis'] = alerte(df['Nox_opsis_pred'], 350, 450)
+    return df
+
+df = compute_predictions(uploaded_file.getvalue())
+
+# 6. Distribution des alertes
 st.subheader("Distribution des alertes NOx")
-fig, axes = plt.subplots(1,2, figsize=(12,4))
-df['Alerte_baf'].value_counts().plot.bar(ax=axes[0], title="BAF")
-df['Alerte_opsis'].value_counts().plot.bar(ax=axes[1], title="OPSIS")
-st.pyplot(fig)
+c1, c2 = st.columns(2)
+c1.markdown("**BAF**")
+c1.bar_chart(df['Alerte_baf'].value_counts())
+c2.markdown("**OPSIS**")
+c2.bar_chart(df['Alerte_opsis'].value_counts())
 
-# 8. Filtre date & scatter
+# 7. Filtre date & scatter
 st.subheader("Visualisation interactive")
 target = st.selectbox("Type NOx", ["BAF","OPSIS"])
 start, end = st.date_input("Plage de dates", [df.date.min(), df.date.max()])
-df_f = df[(df.date>=start)&(df.date<=end)]
+dates = df.date.to_numpy()
+i0 = dates.searchsorted(np.datetime64(start), side='left')
+i1 = dates.searchsorted(np.datetime64(end), side='right')
+df_f = df.iloc[i0:i1]
 
 col_pred  = 'Nox_baf_pred'   if target=="BAF"   else 'Nox_opsis_pred'
 col_alert = 'Alerte_baf'     if target=="BAF"   else 'Alerte_opsis'
 seuils    = (400,500)        if target=="BAF"   else (350,450)
 
-fig, ax = plt.subplots(figsize=(12,5))
-colors = {"OK":"green","ATTENTION":"orange","DANGER":"red"}
-for lvl,c in colors.items():
-    sub = df_f[df_f[col_alert]==lvl]
-    ax.scatter(sub.date, sub[col_pred], label=lvl, c=c, s=10)
+fig = px.scatter(df_f, x="date", y=col_pred, color=col_alert,
+                 color_discrete_map={"OK":"green","ATTENTION":"orange","DANGER":"red"},
+                 title=f"{target} prédits")
 for s in seuils:
-    ax.axhline(s, linestyle="--")
-ax.legend(); ax.set_title(f"{target} prédits")
-st.pyplot(fig)
+    fig.add_hline(y=s, line_dash="dash")
+st.plotly_chart(fig, use_container_width=True)
+
+# 8. Téléchargement CSV des résultats
+@st.cache_data(show_spinner=False, max_entries=4)
+def to_csv_bytes(file_bytes: bytes) -> bytes:
+    # Clé = le fichier importé : Streamlit n'échantillonne que les grands DataFrames pour le hash
+    return compute_predictions(file_bytes).to_csv(index=False).encode('utf-8')
 
-# 9. Téléchargement CSV des résultats
 st.subheader("Télécharger les résultats")
-csv = df.to_csv(index=False).encode('utf-8')
+csv = to_csv_bytes(uploaded_file.getvalue())
 st.download_button("📥 Télécharger", csv, "resultats_nox.csv", "text/csv")